@@ -1,28 +1,221 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import datetime
-import plotly.express as px
+import os
+import threading
+import time
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
+import plotly.graph_objects as go
+from plotly_resampler import FigureResampler
+
+COLUMNS = ['日期', '類別', '金額', '類型', '備註']
+SCHEMA = pa.schema([
+    ('日期', pa.timestamp('ns')),
+    ('類別', pa.string()),
+    ('金額', pa.float32()),
+    ('類型', pa.string()),
+    ('備註', pa.string())
+])
+# Persistence is opt-in: set ACCOUNT_APP_DATA_DIR (relative paths resolve next to this
+# file) to keep transactions in a Parquet dataset there. Each flush of the insert buffer
+# adds one file. The directory is a single ledger shared by every browser session, so
+# only enable it for a single-user deployment; without it the ledger is per session.
+DATA_DIR = (
+    Path(__file__).parent / os.environ['ACCOUNT_APP_DATA_DIR']
+    if os.environ.get('ACCOUNT_APP_DATA_DIR') else None
+)
+# Raising this batches writes into fewer files, but unflushed rows are lost on refresh
+FLUSH_EVERY = 1
+# Once the dataset has more parts than this, a flush merges them into one
+COMPACT_AFTER = 20
+TYPES = ['收入', '支出']
+# Sort option -> (precomputed order in session state, descending)
+SORT_OPTIONS = {
+    '日期 (新到舊)': ('_order_by_date', True),
+    '日期 (舊到新)': ('_order_by_date', False),
+    '金額 (高到低)': ('_order_by_amount', True),
+    '金額 (低到高)': ('_order_by_amount', False)
+}
+# Tables render this many rows unless the user asks for the full list
+VISIBLE_ROWS = 500
+# Above this many points the trend charts ship a downsampled trace to the browser
+RESAMPLE_THRESHOLD = 1000
+# Built figures also live in each session's _last_report, so the process-wide figure
+# caches only absorb rebuilds: a couple of entries per chart title is enough
+FIGURE_CACHE_ENTRIES = 4
+
+def codes_isin(column: pd.Series, values) -> np.ndarray:
+    # Membership on the categorical codes rather than on the strings themselves
+    wanted = column.cat.categories.get_indexer(values)
+    return np.isin(column.cat.codes.to_numpy(), wanted[wanted >= 0])
+
+def totals_by_type(df: pd.DataFrame):
+    # One grouped pass over the float32 column; bincount accumulates in float64
+    totals = np.bincount(
+        df['類型'].cat.codes.to_numpy(),
+        weights=df['金額'].to_numpy(),
+        minlength=len(TYPES)
+    )
+    return float(totals[TYPES.index('收入')]), float(totals[TYPES.index('支出')])
+
+def daily_series(daily: dict):
+    dates = tuple(sorted(daily))
+    return dates, tuple(daily[date] for date in dates)
+
+@st.cache_data(show_spinner=False, max_entries=FIGURE_CACHE_ENTRIES)
+def daily_line(dates: tuple, amounts: tuple, name: str, title: str) -> go.Figure:
+    x = pd.DatetimeIndex(dates)
+    y = np.array(amounts, dtype=np.float64)
+    if len(x) > RESAMPLE_THRESHOLD:
+        fig = FigureResampler(go.Figure(), default_n_shown_samples=RESAMPLE_THRESHOLD)
+        fig.add_trace(go.Scattergl(name=name, mode='lines'), hf_x=x, hf_y=y)
+    else:
+        fig = go.Figure(go.Scattergl(x=x, y=y, name=name, mode='lines'))
+    fig.update_layout(title=title, xaxis_title='日期', yaxis_title='金額')
+    return fig
+
+def category_totals(df: pd.DataFrame):
+    totals = df.groupby('類別', observed=True)['金額'].sum()
+    return tuple(totals.index), tuple(totals.to_numpy().tolist())
+
+@st.cache_data(show_spinner=False, max_entries=FIGURE_CACHE_ENTRIES)
+def category_pie(categories: tuple, amounts: tuple, title: str) -> go.Figure:
+    fig = go.Figure(go.Pie(labels=categories, values=amounts))
+    fig.update_layout(title=title)
+    return fig
+
+@st.cache_resource
+def dataset_lock() -> threading.Lock:
+    # One lock per server process; sessions run as threads and share it
+    return threading.Lock()
+
+def write_part(table: pa.Table, path: Path):
+    # Write beside the target and rename, so readers never glob a half-written part
+    tmp = path.with_name(path.name + '.tmp')
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
+
+def read_dataset():
+    with dataset_lock():
+        parts = sorted(DATA_DIR.glob('*.parquet'))
+        if not parts:
+            return None
+        return pa.concat_tables(pq.read_table(part, schema=SCHEMA) for part in parts)
+
+def compact_dataset():
+    with dataset_lock():
+        parts = sorted(DATA_DIR.glob('*.parquet'))
+        if len(parts) <= COMPACT_AFTER:
+            return
+        table = pa.concat_tables(pq.read_table(part, schema=SCHEMA) for part in parts)
+        # Reuse the newest input's name: parts flushed meanwhile still sort after it
+        write_part(table, parts[-1])
+        for part in parts[:-1]:
+            part.unlink(missing_ok=True)
+
+def split_by_type(df: pd.DataFrame, is_expense: np.ndarray):
+    return (df[is_expense], df[~is_expense]) + totals_by_type(df)
 
 class FinanceTracker:
     def __init__(self):
-        if 'transactions' not in st.session_state:
-            st.session_state['transactions'] = pd.DataFrame(
-                columns=['日期', '類別', '金額', '類型', '備註']
-            )
-            st.session_state['transactions']['日期'] = pd.to_datetime(st.session_state['transactions']['日期'])
-        
         if 'categories' not in st.session_state:
             st.session_state['categories'] = [
                 '餐飲', '交通', '娛樂', '醫療', '教育', 
                 '購物', '房租', '水電瓦斯', '旅行', '其他'
             ]
+        if '_cat_set' not in st.session_state:
+            st.session_state['_cat_set'] = set(st.session_state['categories'])
+        if '_all_categories' not in st.session_state:
+            # Deleted categories stay here so older records keep a valid 類別 code
+            st.session_state['_all_categories'] = list(st.session_state['categories'])
+
+        if '_records' not in st.session_state:
+            st.session_state['_records'] = []
+            st.session_state['_is_expense'] = []
+            st.session_state['_daily_exp'] = {}
+            st.session_state['_daily_inc'] = {}
+            # Sorted keys plus the record positions in that order, kept up to date on insert
+            st.session_state['_dates_sorted'] = np.array([], dtype='datetime64[ns]')
+            st.session_state['_order_by_date'] = np.array([], dtype=np.int64)
+            st.session_state['_amounts_sorted'] = np.array([], dtype=np.float32)
+            st.session_state['_order_by_amount'] = np.array([], dtype=np.int64)
+            st.session_state['_version'] = 0
+            st.session_state['_memo'] = {}
+            st.session_state['_pending'] = []
+            st.session_state['_report_dirty'] = True
+            st.session_state['_last_report'] = ([], [])
+            self._load_transactions()
+
+        if '_notices' not in st.session_state:
+            st.session_state['_notices'] = []
         if 'budget' not in st.session_state:
             st.session_state['budget'] = 0.0
 
+    def _memo(self, key, build):
+        # Derived views are rebuilt only after _version is bumped by a mutation
+        memo = st.session_state['_memo']
+        if memo.get('_version') != st.session_state['_version']:
+            memo.clear()
+            memo['_version'] = st.session_state['_version']
+        if key not in memo:
+            memo[key] = build()
+        return memo[key]
+
+    def _build_df(self) -> pd.DataFrame:
+        return pd.DataFrame.from_records(
+            st.session_state['_records'], columns=COLUMNS
+        ).astype({
+            '日期': 'datetime64[ns]',
+            '類別': pd.CategoricalDtype(st.session_state['_all_categories']),
+            '金額': 'float32',
+            '類型': pd.CategoricalDtype(TYPES),
+            '備註': 'string'
+        })
+
+    def _df(self) -> pd.DataFrame:
+        return self._memo('df', self._build_df)
+
+    def _mask(self) -> np.ndarray:
+        return self._memo(
+            'mask',
+            lambda: np.array(st.session_state['_is_expense'], dtype=bool)
+        )
+
+    def _split(self):
+        return self._memo('split', lambda: split_by_type(self._df(), self._mask()))
+
+    def _sorted(self, sort_by: str, mask: np.ndarray = None) -> pd.DataFrame:
+        order_key, descending = SORT_OPTIONS[sort_by]
+        order = st.session_state[order_key]
+        if mask is not None:
+            order = order[mask[order]]
+        if descending:
+            order = order[::-1]
+        return self._df().iloc[order]
+
+    def expense_view(self) -> pd.DataFrame:
+        return self._split()[0]
+
+    def income_view(self) -> pd.DataFrame:
+        return self._split()[1]
+
+    def show_notices(self):
+        # Messages queued before an st.rerun() would otherwise never be seen
+        for message in st.session_state['_notices']:
+            st.success(message)
+        st.session_state['_notices'] = []
+
+    def _notify(self, message: str):
+        st.session_state['_notices'].append(message)
+
+    @st.fragment
     def add_transaction_sidebar(self):
-        st.sidebar.header("新增交易")
+        st.header("新增交易")
         
-        with st.sidebar.form(key='add_transaction_form'):
+        with st.form(key='add_transaction_form'):
             date = st.date_input("日期", datetime.date.today())
             category = st.selectbox("類別", st.session_state['categories'])
             amount = st.number_input("金額", min_value=0.01, step=0.01)
@@ -31,12 +224,18 @@ class FinanceTracker:
             submit_transaction = st.form_submit_button(label='新增交易')
 
         if submit_transaction:
-            self._add_transaction(date, category, amount, transaction_type, note)
+            if category is None:
+                # The picker is empty once every category has been deleted
+                st.error("請先新增類別！")
+            else:
+                self._add_transaction(date, category, amount, transaction_type, note)
+                st.rerun()
 
+    @st.fragment
     def manage_categories_sidebar(self):
-        st.sidebar.header("管理類別")
+        st.header("管理類別")
         
-        with st.sidebar.form(key='manage_categories_form'):
+        with st.form(key='manage_categories_form'):
             new_category = st.text_input("新增類別")
             delete_category = st.selectbox(
                 "刪除類別", 
@@ -47,11 +246,12 @@ class FinanceTracker:
 
         if submit_category:
             self._update_categories(new_category, delete_category)
+            st.rerun()
 
     def display_transactions(self):
         st.subheader("交易紀錄")
         
-        if not st.session_state['transactions'].empty:
+        if st.session_state['_records']:
             col1, col2, col3 = st.columns(3)
             with col1:
                 filter_type = st.multiselect(
@@ -66,35 +266,26 @@ class FinanceTracker:
                     default=st.session_state['categories']
                 )
             with col3:
-                sort_by = st.selectbox(
-                    "排序方式",
-                    ['日期 (新到舊)', '日期 (舊到新)', '金額 (高到低)', '金額 (低到高)']
-                )
+                sort_by = st.selectbox("排序方式", list(SORT_OPTIONS))
 
-            df = st.session_state['transactions']
-            df = df[df['類型'].isin(filter_type)]
-            df = df[df['類別'].isin(filter_category)]
-            
-            if sort_by == '日期 (新到舊)':
-                df = df.sort_values('日期', ascending=False)
-            elif sort_by == '日期 (舊到新)':
-                df = df.sort_values('日期', ascending=True)
-            elif sort_by == '金額 (高到低)':
-                df = df.sort_values('金額', ascending=False)
+            if (set(filter_type) >= set(TYPES) and
+                    set(filter_category) >= set(st.session_state['_all_categories'])):
+                # Nothing is filtered out, so the sorted frame can be reused until the next insert
+                df = self._memo(('sorted', sort_by), lambda: self._sorted(sort_by))
             else:
-                df = df.sort_values('金額', ascending=True)
+                df = self._df()
+                mask = codes_isin(df['類型'], filter_type) & codes_isin(df['類別'], filter_category)
+                df = self._sorted(sort_by, mask)
 
-            st.dataframe(df, use_container_width=True)
+            self._show_table(df, 'show_all_transactions')
         else:
             st.info("目前尚無交易紀錄。")
 
     def generate_report(self):
         st.subheader("財務報表")
         
-        if not st.session_state['transactions'].empty:
-            transactions = st.session_state['transactions']
-            expenses = transactions[transactions['類型'] == '支出']['金額'].sum()
-            incomes = transactions[transactions['類型'] == '收入']['金額'].sum()
+        if st.session_state['_records']:
+            _, _, incomes, expenses = self._split()
             net_balance = incomes - expenses
 
             col1, col2, col3 = st.columns(3)
@@ -106,13 +297,23 @@ class FinanceTracker:
                 st.metric("收支結餘", f"${net_balance:,.2f}", 
                          delta=f"${net_balance:,.2f}")
 
+            # Figures are rebuilt only on request or after the ledger changed
+            if st.button("更新報表") or st.session_state['_report_dirty']:
+                st.session_state['_last_report'] = (
+                    self._expense_figures(), self._income_figures()
+                )
+                st.session_state['_report_dirty'] = False
+            expense_figures, income_figures = st.session_state['_last_report']
+
             tab1, tab2 = st.tabs(["支出分析", "收入分析"])
             
             with tab1:
-                self._plot_expense_analysis()
+                for fig in expense_figures:
+                    st.plotly_chart(fig, use_container_width=True)
             
             with tab2:
-                self._plot_income_analysis()
+                for fig in income_figures:
+                    st.plotly_chart(fig, use_container_width=True)
         else:
             st.info("目前無法生成報表，因為尚無交易紀錄。")
 
@@ -130,12 +331,14 @@ class FinanceTracker:
             )
             st.session_state['budget'] = new_budget
 
-        if not st.session_state['transactions'].empty:
-            current_month = pd.to_datetime(datetime.date.today().replace(day=1))
-            month_expenses = st.session_state['transactions'][
-                (st.session_state['transactions']['類型'] == '支出') &
-                (st.session_state['transactions']['日期'] >= current_month)
-            ]['金額'].sum()
+        if st.session_state['_records']:
+            current_month = np.datetime64(datetime.date.today().replace(day=1), 'ns')
+            expenses = self.expense_view()
+            # Reduce the float32 column directly, accumulating in float64 so cents stay exact
+            in_month = expenses['日期'].to_numpy() >= current_month
+            month_expenses = float(np.add.reduce(
+                expenses['金額'].to_numpy()[in_month], dtype=np.float64
+            ))
 
             with col2:
                 progress = min(month_expenses / new_budget * 100, 100) if new_budget > 0 else 0
@@ -165,94 +368,150 @@ class FinanceTracker:
             st.error("開始日期不能晚於結束日期！")
 
     def _add_transaction(self, date, category, amount, transaction_type, note):
-        new_transaction = pd.DataFrame({
-            '日期': [pd.to_datetime(date)],  # Convert to pandas datetime
-            '類別': [category],
-            '金額': [amount],
-            '類型': [transaction_type],
-            '備註': [note]
-        })
-        st.session_state['transactions'] = pd.concat(
-            [st.session_state['transactions'], new_transaction],
-            ignore_index=True
-        )
-        st.success("✅ 交易新增成功！")
+        record = self._append_record(date, category, amount, transaction_type, note)
+        row = len(st.session_state['_records']) - 1
+        self._insert_sorted('_dates_sorted', '_order_by_date', record['日期'].to_datetime64(), row)
+        self._insert_sorted('_amounts_sorted', '_order_by_amount', record['金額'], row)
+        st.session_state['_version'] += 1
+        st.session_state['_report_dirty'] = True
+        self._persist(record)
+        self._notify("✅ 交易新增成功！")
+
+    def _append_record(self, date, category, amount, transaction_type, note) -> dict:
+        date = pd.Timestamp(date)
+        amount = np.float32(amount)
+        record = {
+            '日期': date,
+            '類別': category,
+            '金額': amount,
+            '類型': transaction_type,
+            '備註': note
+        }
+        st.session_state['_records'].append(record)
+        st.session_state['_is_expense'].append(transaction_type == '支出')
+        daily = st.session_state['_daily_exp' if transaction_type == '支出' else '_daily_inc']
+        # Accumulate in float64, like totals_by_type, so daily sums match the report totals
+        daily[date] = daily.get(date, 0.0) + float(amount)
+        return record
+
+    def _load_transactions(self):
+        if DATA_DIR is None:
+            return
+        table = read_dataset()
+        if table is None:
+            return
+
+        df = table.to_pandas()
+        dates = df['日期'].to_numpy(dtype='datetime64[ns]')
+        amounts = df['金額'].to_numpy(dtype=np.float32)
+        is_expense = (df['類型'] == '支出').to_numpy()
+
+        st.session_state['_records'] = [
+            dict(zip(COLUMNS, row))
+            for row in zip(df['日期'], df['類別'], amounts, df['類型'], df['備註'])
+        ]
+        st.session_state['_is_expense'] = is_expense.tolist()
+        daily_sums = df['金額'].astype('float64').groupby([is_expense, df['日期']]).sum()
+        for (expense, date), amount in daily_sums.items():
+            st.session_state['_daily_exp' if expense else '_daily_inc'][date] = float(amount)
+
+        # A null 類別 would make every later CategoricalDtype construction fail
+        for category in df['類別'].dropna().unique():
+            if category not in st.session_state['_cat_set']:
+                st.session_state['categories'].append(category)
+                st.session_state['_cat_set'].add(category)
+            if category not in st.session_state['_all_categories']:
+                st.session_state['_all_categories'].append(category)
+
+        # One stable argsort per key instead of a binary insert per loaded row
+        for keys, keys_name, order_name in (
+            (dates, '_dates_sorted', '_order_by_date'),
+            (amounts, '_amounts_sorted', '_order_by_amount')
+        ):
+            order = np.argsort(keys, kind='stable')
+            st.session_state[keys_name] = keys[order]
+            st.session_state[order_name] = order
+
+    def _persist(self, record: dict):
+        if DATA_DIR is None:
+            return
+        pending = st.session_state['_pending']
+        pending.append(record)
+        if len(pending) >= FLUSH_EVERY:
+            DATA_DIR.mkdir(exist_ok=True)
+            write_part(
+                pa.Table.from_pylist(pending, schema=SCHEMA),
+                DATA_DIR / f'part-{time.time_ns()}.parquet'
+            )
+            pending.clear()
+            compact_dataset()
+
+    def _show_table(self, df: pd.DataFrame, key: str):
+        if len(df) > VISIBLE_ROWS and not st.checkbox(f"顯示全部 ({len(df)} 筆)", key=key):
+            df = df.head(VISIBLE_ROWS)
+        st.dataframe(df, use_container_width=True, height=400)
+
+    def _insert_sorted(self, keys_name: str, order_name: str, key, row: int):
+        keys = st.session_state[keys_name]
+        k = np.searchsorted(keys, key, side='right')
+        st.session_state[keys_name] = np.insert(keys, k, key)
+        st.session_state[order_name] = np.insert(st.session_state[order_name], k, row)
 
     def _update_categories(self, new_category: str, delete_category: str):
-        if new_category and new_category not in st.session_state['categories']:
+        if new_category and new_category not in st.session_state['_cat_set']:
             st.session_state['categories'].append(new_category)
-            st.success(f"✅ 類別 '{new_category}' 新增成功！")
+            st.session_state['_cat_set'].add(new_category)
+            if new_category not in st.session_state['_all_categories']:
+                st.session_state['_all_categories'].append(new_category)
+                df = st.session_state['_memo'].get('df')
+                if df is not None:
+                    df['類別'] = df['類別'].cat.add_categories([new_category])
+            self._notify(f"✅ 類別 '{new_category}' 新增成功！")
         
         if delete_category:
+            st.session_state['_cat_set'].discard(delete_category)
             st.session_state['categories'].remove(delete_category)
-            st.success(f"✅ 類別 '{delete_category}' 刪除成功！")
+            self._notify(f"✅ 類別 '{delete_category}' 刪除成功！")
 
-    def _plot_expense_analysis(self):
-        transactions = st.session_state['transactions']
-        expenses = transactions[transactions['類型'] == '支出']
+    def _expense_figures(self) -> list:
+        expenses = self.expense_view()
         
-        if not expenses.empty:
-            # Category pie chart
-            fig_pie = px.pie(
-                expenses,
-                values='金額',
-                names='類別',
-                title='支出類別分布'
-            )
-            st.plotly_chart(fig_pie, use_container_width=True)
-
-            # Time series chart
-            daily_expenses = expenses.groupby('日期')['金額'].sum().reset_index()
-            fig_line = px.line(
-                daily_expenses,
-                x='日期',
-                y='金額',
-                title='每日支出趨勢'
-            )
-            st.plotly_chart(fig_line, use_container_width=True)
+        if expenses.empty:
+            return []
+
+        # Category pie chart
+        fig_pie = category_pie(*category_totals(expenses), '支出類別分布')
 
-    def _plot_income_analysis(self):
-        transactions = st.session_state['transactions']
-        incomes = transactions[transactions['類型'] == '收入']
+        # Time series chart
+        dates, amounts = daily_series(st.session_state['_daily_exp'])
+        fig_line = daily_line(dates, amounts, '支出', '每日支出趨勢')
+        return [fig_pie, fig_line]
+
+    def _income_figures(self) -> list:
+        incomes = self.income_view()
         
-        if not incomes.empty:
-            # Category pie chart
-            fig_pie = px.pie(
-                incomes,
-                values='金額',
-                names='類別',
-                title='收入來源分布'
-            )
-            st.plotly_chart(fig_pie, use_container_width=True)
-
-            # Time series chart
-            daily_incomes = incomes.groupby('日期')['金額'].sum().reset_index()
-            fig_line = px.line(
-                daily_incomes,
-                x='日期',
-                y='金額',
-                title='每日收入趨勢'
-            )
-            st.plotly_chart(fig_line, use_container_width=True)
+        if incomes.empty:
+            return []
+
+        # Category pie chart
+        fig_pie = category_pie(*category_totals(incomes), '收入來源分布')
+
+        # Time series chart
+        dates, amounts = daily_series(st.session_state['_daily_inc'])
+        fig_line = daily_line(dates, amounts, '收入', '每日收入趨勢')
+        return [fig_pie, fig_line]
 
     def _show_filtered_transactions(self, start_date: datetime.date, end_date: datetime.date):
-        start_datetime = pd.to_datetime(start_date)
-        end_datetime = pd.to_datetime(end_date)
-        
-        filtered_transactions = st.session_state['transactions'][
-            (st.session_state['transactions']['日期'] >= start_datetime) &
-            (st.session_state['transactions']['日期'] <= end_datetime)
-        ]
+        # Binary search the sorted dates instead of comparing every row
+        dates = st.session_state['_dates_sorted']
+        lo = np.searchsorted(dates, np.datetime64(start_date, 'ns'), side='left')
+        hi = np.searchsorted(dates, np.datetime64(end_date, 'ns'), side='right')
+        filtered_transactions = self._df().iloc[st.session_state['_order_by_date'][lo:hi]]
 
         if not filtered_transactions.empty:
             st.write(f"查詢期間: {start_date} 至 {end_date}")
             
-            income = filtered_transactions[
-                filtered_transactions['類型'] == '收入'
-            ]['金額'].sum()
-            expense = filtered_transactions[
-                filtered_transactions['類型'] == '支出'
-            ]['金額'].sum()
+            income, expense = totals_by_type(filtered_transactions)
             
             col1, col2, col3 = st.columns(3)
             with col1:
@@ -262,7 +521,7 @@ class FinanceTracker:
             with col3:
                 st.metric("期間結餘", f"${income - expense:,.2f}")
             
-            st.dataframe(filtered_transactions, use_container_width=True)
+            self._show_table(filtered_transactions, 'show_all_filtered')
         else:
             st.info("此區間內無交易紀錄。")
 
@@ -277,9 +536,13 @@ def main():
     
     tracker = FinanceTracker()
     
-    # Sidebar
-    tracker.add_transaction_sidebar()
-    tracker.manage_categories_sidebar()
+    # Sidebar; each form is a fragment and only reruns the whole app after a change
+    with st.sidebar:
+        tracker.show_notices()
+        if DATA_DIR is not None:
+            st.caption(f"交易紀錄儲存於 {DATA_DIR}，所有瀏覽器工作階段共用同一本帳。")
+        tracker.add_transaction_sidebar()
+        tracker.manage_categories_sidebar()
     
     # Main content
     tab1, tab2, tab3, tab4 = st.tabs(["交易紀錄", "報表", "預算", "查詢區間"])